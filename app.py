@@ -1,11 +1,8 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import numpy as np
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
-import re 
+from core import get_data, refresh_data, take_snapshots, compound, month_range, downsample_trend
 
 # --- 設定頁面資訊 ---
 st.set_page_config(page_title="Jeffy's FIRE 戰情室 🔥", page_icon="🛡️", layout="wide")
@@ -20,83 +17,175 @@ except KeyError:
     st.error("⚠️ Secrets Error: 請檢查 secrets.toml")
     st.stop() 
 
-# --- 讀取數據函數 ---
-@st.cache_data(ttl=10) 
-def load_data(url):
-    try:
-        df_total = pd.read_csv(url, header=1) 
-        df_total.columns = df_total.columns.str.strip() 
-        
-        target_cols = [
-            '真實總資產(TWD)', '總資產(TWD)', '總資產+汽車折舊', '汽車預估價格(GPT模型)',
-            '股票價值(USD)', '股票成本(USD)', 
-            'ETF價值(EUR)', 'ETF(EUR)', 
-            '台幣現金(TWD)', '外幣現金(EUR)', '不動產(TWD)', 
-            '加密貨幣(USD)', '其他(TWD)', 
-            'USDTWD', 'EURTWD', '總資產增額(TWD)'
-        ]
-        
-        for col in target_cols:
-            if col in df_total.columns:
-                # 強力清洗：先除逗號，再除雜訊
-                cleaned = df_total[col].astype(str).str.replace(',', '', regex=False)
-                df_total[col] = cleaned.apply(lambda x: re.sub(r'[^\d\.\-]', '', x))
-                df_total[col] = pd.to_numeric(df_total[col], errors='coerce').fillna(0)
-            else:
-                df_total[col] = 0
-
-        df_total['日期'] = pd.to_datetime(df_total['日期'], errors='coerce')
-        
-        # 建立有效資產
-        df_total['Effective_Asset'] = np.where(
-            df_total['真實總資產(TWD)'] > 0, 
-            df_total['真實總資產(TWD)'], 
-            df_total['總資產+汽車折舊']
-        )
-        
-        # 過濾無效行
-        df_total = df_total[df_total['Effective_Asset'] > 0].copy()
-        df_total = df_total.sort_values('日期').reset_index(drop=True)
-        
-        return df_total
-    except Exception as e:
-        st.error(f"⚠️ 數據讀取錯誤: {e}") 
-        return pd.DataFrame() 
+# --- 圖表建構 ---
+# Figure 以實際輸入為鍵放進 cache_resource：只動側邊欄預測參數時，其他圖直接取回同一個物件
+@st.cache_resource(max_entries=16)
+def build_trend_fig(df):
+    df_trend = downsample_trend(df)
+    # 這張圖有 rangeslider，WebGL trace 在 rangeslider 的縮圖裡畫不出來，所以維持 SVG scatter (點數已由 LTTB 限制)
+    fig = go.Figure(go.Scatter(
+        x=df_trend['日期'], y=df_trend['Effective_Asset'], mode='lines+markers',
+        line=dict(width=3, color='#00CC96')
+    ))
+    fig.update_layout(
+        template="plotly_dark",
+        xaxis=dict(rangeslider=dict(visible=True), type="date", title='日期'),
+        yaxis_title='Effective_Asset',
+        margin=dict(l=20, r=20, t=20, b=20),
+        height=400
+    )
+    return fig
+
+# 樹狀圖的 (類別, 資產) 標籤固定不變，只有金額隨最新快照變動
+TREEMAP_CATEGORIES = ('投資組合', '投資組合', '投資組合', '防禦資產', '防禦資產', '防禦資產', '消費資產', '消費資產')
+TREEMAP_ASSETS = ('美股 (Stocks)', '歐股/ETF (ETFs)', '加密貨幣 (Crypto)', '不動產 (Real Estate)',
+                  '台幣現金 (TWD Cash)', '外幣現金 (FX Cash)', '汽車 (Car)', '其他')
+
+@st.cache_resource(max_entries=16)
+def build_treemap_fig(stock_val, etf_val, crypto_val, real_estate_val, twd_cash_val, fx_cash_val, car_val, other_val):
+    # [修復 2] 改用 px.treemap 自動計算父層級數值，解決顯示為 0 的問題
+    treemap_df = pd.DataFrame({
+        'Category': TREEMAP_CATEGORIES,
+        'Asset': TREEMAP_ASSETS,
+        'Value': [stock_val, etf_val, crypto_val, real_estate_val, twd_cash_val, fx_cash_val, car_val, other_val],
+    })
+    # 過濾掉 0 的項目
+    treemap_df = treemap_df[treemap_df['Value'] > 0]
+    if treemap_df.empty:
+        return None
+
+    fig = px.treemap(treemap_df, path=['Category', 'Asset'], values='Value',
+                     color='Category', color_discrete_map={'投資組合':'#FF4B4B', '防禦資產':'#00CC96', '消費資產':'#808080'})
+    fig.update_layout(margin=dict(t=0, l=0, r=0, b=0), height=400)
+    return fig
 
-df_total = load_data(SPREADSHEET_URL)
+@st.cache_resource(max_entries=16)
+def build_pnl_fig(stock_pnl, etf_pnl, crypto_pnl):
+    pnl = np.array([stock_pnl, etf_pnl, crypto_pnl], dtype=np.float64)
+    df_pnl = pd.DataFrame({
+        'Asset': ['美股', 'ETF', '加密貨幣'],
+        'PnL': pnl,
+        'Color': np.where(pnl >= 0, '#00CC96', '#FF4B4B'),
+    })
+
+    fig = px.bar(df_pnl, x='PnL', y='Asset', orientation='h', text='PnL',
+                 title="各類資產損益貢獻 (估)", template="plotly_dark")
+    fig.update_traces(marker_color=df_pnl['Color'], texttemplate='%{text:,.0f}', textposition='auto')
+    return fig
+
+@st.cache_resource(max_entries=16)
+def build_currency_fig(usd_exp, eur_exp, twd_exp):
+    fig = px.pie(
+        values=[usd_exp, eur_exp, twd_exp], 
+        names=['USD (美元)', 'EUR (歐元)', 'TWD (台幣)'],
+        color_discrete_sequence=['#00CC96', '#636EFA', '#EF553B'],
+        hole=0.5
+    )
+    fig.update_layout(showlegend=True, height=350)
+    return fig
+
+@st.cache_resource(max_entries=16)
+def build_forecast_fig(df_hist, df_fut, fire_goal):
+    # 歷史與預測直接畫成兩條 WebGL (scattergl) trace，不再 concat 成長表再讓 px 依 Type 拆開
+    df_hist = downsample_trend(df_hist)
+    fig = go.Figure()
+    fig.add_trace(go.Scattergl(x=df_hist['日期'], y=df_hist['Effective_Asset'], mode='lines',
+                               name='History', line=dict(color='#00CC96')))
+    fig.add_trace(go.Scattergl(x=df_fut['日期'], y=df_fut['Effective_Asset'], mode='lines',
+                               name='Forecast', line=dict(color='#FFA500')))
+    fig.update_layout(template="plotly_dark", xaxis_title='日期', yaxis_title='Effective_Asset',
+                      legend_title_text='Type')
+    fig.add_hline(y=fire_goal, line_dash="dot", line_color="red", annotation_text=f"FIRE Goal")
+    return fig
+
+# --- 預測面板 ---
+# 只影響預測的參數 (年數、折舊、每月投入) 放在 fragment 裡：調整時只重跑這一區，KPI 與上方圖表不必重畫
+# (fragment 不能寫入側邊欄，所以這幾個控制項改放在預測區塊內)
+@st.fragment
+def forecast_panel(df_hist, start_date, values, rates, curr_car, default_contribution, fire_goal):
+    stock_val, etf_val, crypto_val, curr_safe = values
+    rate_stock, rate_etf, rate_crypto, rate_safe = rates
+
+    st.divider()
+    title = st.empty()
+    col_y, col_d, col_m = st.columns(3)
+    forecast_years = col_y.slider("模擬未來年數", 1, 25, 5)
+    car_depreciation_rate = col_d.slider("汽車年折舊率 (%)", 5.0, 30.0, 15.0, 1.0)
+    monthly_contribution = col_m.number_input("每月投入 (TWD)", value=int(default_contribution), step=5000)
+    title.subheader(f"🔮 未來 {forecast_years} 年資產模擬 (分項複利)")
+    
+    st.info(f"""
+    **模型參數：**
+    - 美股成長: **{rate_stock}%** | ETF成長: **{rate_etf}%** | 加密成長: **{rate_crypto}%**
+    - 房產/現金成長: **{rate_safe}%** | 汽車折舊: **{car_depreciation_rate}%**
+    - 每月投入: **${monthly_contribution:,.0f}**
+    """)
+
+    months = forecast_years * 12
+    
+    invest_sum = stock_val + etf_val + crypto_val + curr_safe
+    if invest_sum == 0: invest_sum = 1
+    
+    alloc_stock = monthly_contribution * (stock_val / invest_sum)
+    alloc_etf = monthly_contribution * (etf_val / invest_sum)
+    alloc_crypto = monthly_contribution * (crypto_val / invest_sum)
+    alloc_safe = monthly_contribution * (curr_safe / invest_sum)
+
+    # 各資產以封閉解一次算出整段月序列，汽車按月折舊 (不低於 0)
+    n = np.arange(1, months + 1)
+    total = (
+        compound(stock_val, rate_stock, alloc_stock, n)
+        + compound(etf_val, rate_etf, alloc_etf, n)
+        + compound(crypto_val, rate_crypto, alloc_crypto, n)
+        + compound(curr_safe, rate_safe, alloc_safe, n)
+        + np.maximum(curr_car * (1 - car_depreciation_rate/100/12) ** n, 0)
+    )
+    df_fut = pd.DataFrame({'日期': month_range(start_date, months), 'Effective_Asset': total})
+    
+    fig_cast = build_forecast_fig(df_hist, df_fut, fire_goal)
+    # 固定 key：圖表身分不隨 figure 內容改變，拉動滑桿時前端原地更新 trace 而不是整張重建
+    st.plotly_chart(fig_cast, use_container_width=True, key='forecast_chart')
+    
+    final_v = total[-1]
+    st.success(f"🎯 **預測結果：** {forecast_years} 年後資產約 **${final_v:,.0f}**")
+
+# --- 讀取數據 (下載、清洗、快取都在 core.py) ---
+df_total = get_data(SPREADSHEET_URL, '總資產+汽車折舊', 'fire_dashboard')
 
 # --- 介面呈現 ---
 st.title("🛡️ Jeffy's FIRE Command Center")
 
 if not df_total.empty and len(df_total) > 0:
+    # plotly 只在有資料要畫圖時才載入 (首次載入約數百 ms)，讀取失敗的畫面不必等它
+    import plotly.express as px
+    import plotly.graph_objects as go
     
     # --- 基礎數據準備 ---
-    latest = df_total.iloc[-1]
-    prev = df_total.iloc[-2] if len(df_total) > 1 else latest
+    latest, prev = take_snapshots(df_total, -1, -2 if len(df_total) > 1 else -1)
     
     # 匯率
-    usd_rate = latest.get('USDTWD', 32.5) if latest.get('USDTWD', 0) > 10 else 31.5
-    eur_rate = latest.get('EURTWD', 35.0) if latest.get('EURTWD', 0) > 10 else 36.0
+    usd_rate = latest.usd_twd if latest.usd_twd > 10 else 31.5
+    eur_rate = latest.eur_twd if latest.eur_twd > 10 else 36.0
     
     # --- 資產價值 (Market Value) ---
-    stock_val = latest.get('股票價值(USD)', 0) * usd_rate
-    if stock_val == 0: stock_val = latest.get('股票成本(USD)', 0) * usd_rate
+    stock_val = latest.stock_usd * usd_rate
+    if stock_val == 0: stock_val = latest.stock_cost_usd * usd_rate
     
-    etf_val = latest.get('ETF價值(EUR)', 0) * eur_rate
-    if etf_val == 0: etf_val = latest.get('ETF(EUR)', 0) * eur_rate
+    etf_val = latest.etf_eur * eur_rate
+    if etf_val == 0: etf_val = latest.etf_cost_eur * eur_rate
 
-    crypto_val = latest.get('加密貨幣(USD)', 0) * usd_rate
-    fx_cash_val = latest.get('外幣現金(EUR)', 0) * eur_rate
-    twd_cash_val = latest.get('台幣現金(TWD)', 0)
-    real_estate_val = latest.get('不動產(TWD)', 0)
-    other_val = latest.get('其他(TWD)', 0)
-    car_val = latest.get('汽車預估價格(GPT模型)', 0)
+    crypto_val = latest.crypto_usd * usd_rate
+    fx_cash_val = latest.fx_cash_eur * eur_rate
+    twd_cash_val = latest.twd_cash
+    real_estate_val = latest.real_estate
+    other_val = latest.other
+    car_val = latest.car
 
     # 資產成本 (用於損益圖)
-    stock_cost = latest.get('股票成本(USD)', 0) * usd_rate
-    etf_cost = latest.get('ETF(EUR)', 0) * eur_rate
+    stock_cost = latest.stock_cost_usd * usd_rate
+    etf_cost = latest.etf_cost_eur * eur_rate
     
-    total_market_val = latest['Effective_Asset']
+    total_market_val = latest.effective_asset
     
     # --- 側邊欄：還原 V01 設定 ---
     with st.sidebar:
@@ -107,7 +196,6 @@ if not df_total.empty and len(df_total) > 0:
         
         st.divider()
         st.subheader("🔮 分析師估值模型")
-        forecast_years = st.slider("模擬未來年數", 1, 25, 5)
 
         # 1. 情境選擇
         scenario = st.selectbox(
@@ -141,15 +229,8 @@ if not df_total.empty and len(df_total) > 0:
         rate_crypto = col_s3.number_input("加密貨幣", value=def_crypto, step=1.0, format="%.1f")
         rate_safe = col_s4.number_input("房產/現金", value=def_safe, step=0.1, format="%.1f")
         
-        st.markdown("**折舊與投入**")
-        car_depreciation_rate = st.slider("汽車年折舊率 (%)", 5.0, 30.0, 15.0, 1.0)
-        
-        df_gains = df_total[df_total['總資產增額(TWD)'] > 0]
-        hist_avg_gain = df_gains['總資產增額(TWD)'].mean() if not df_gains.empty else 50000
-        monthly_contribution = st.number_input("每月投入 (TWD)", value=int(hist_avg_gain), step=5000)
-        
         if st.button("🔄 刷新"):
-            st.cache_data.clear()
+            refresh_data()
             st.rerun()
 
     # 計算權重
@@ -164,8 +245,8 @@ if not df_total.empty and len(df_total) > 0:
     # --- Row 1: KPI ---
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        diff = latest['Effective_Asset'] - prev['Effective_Asset']
-        pct = (diff / prev['Effective_Asset']) * 100 if prev['Effective_Asset'] != 0 else 0
+        diff = latest.effective_asset - prev.effective_asset
+        pct = (diff / prev.effective_asset) * 100 if prev.effective_asset != 0 else 0
         st.metric("💰 真實總淨值", f"${total_market_val:,.0f}", f"{diff:,.0f} ({pct:.2f}%)")
     with col2:
         st.metric("📊 投資組合隱含CAGR", f"{weighted_cagr:.2f}%", f"情境: {scenario.split('-')[0]}")
@@ -183,36 +264,15 @@ if not df_total.empty and len(df_total) > 0:
 
     with col_main:
         st.subheader("📈 歷史淨值走勢 (History)")
-        fig_trend = px.line(df_total, x='日期', y='Effective_Asset', markers=True, template="plotly_dark")
-        fig_trend.update_traces(line=dict(width=3, color='#00CC96'))
-        fig_trend.update_layout(
-            xaxis=dict(rangeslider=dict(visible=True), type="date"),
-            margin=dict(l=20, r=20, t=20, b=20),
-            height=400
-        )
-        st.plotly_chart(fig_trend, use_container_width=True)
+        fig_trend = build_trend_fig(df_total)
+        st.plotly_chart(fig_trend, use_container_width=True, key='trend_chart')
 
     with col_tree:
         st.subheader("🗺️ 資產板塊 (Asset Map)")
-        # [修復 2] 改用 px.treemap 自動計算父層級數值，解決顯示為 0 的問題
-        treemap_df = pd.DataFrame([
-            {'Category': '投資組合', 'Asset': '美股 (Stocks)', 'Value': stock_val},
-            {'Category': '投資組合', 'Asset': '歐股/ETF (ETFs)', 'Value': etf_val},
-            {'Category': '投資組合', 'Asset': '加密貨幣 (Crypto)', 'Value': crypto_val},
-            {'Category': '防禦資產', 'Asset': '不動產 (Real Estate)', 'Value': real_estate_val},
-            {'Category': '防禦資產', 'Asset': '台幣現金 (TWD Cash)', 'Value': twd_cash_val},
-            {'Category': '防禦資產', 'Asset': '外幣現金 (FX Cash)', 'Value': fx_cash_val},
-            {'Category': '消費資產', 'Asset': '汽車 (Car)', 'Value': car_val},
-            {'Category': '消費資產', 'Asset': '其他', 'Value': other_val}
-        ])
-        # 過濾掉 0 的項目
-        treemap_df = treemap_df[treemap_df['Value'] > 0]
-        
-        if not treemap_df.empty:
-            fig_tree = px.treemap(treemap_df, path=['Category', 'Asset'], values='Value',
-                                  color='Category', color_discrete_map={'投資組合':'#FF4B4B', '防禦資產':'#00CC96', '消費資產':'#808080'})
-            fig_tree.update_layout(margin=dict(t=0, l=0, r=0, b=0), height=400)
-            st.plotly_chart(fig_tree, use_container_width=True)
+        fig_tree = build_treemap_fig(stock_val, etf_val, crypto_val, real_estate_val,
+                                     twd_cash_val, fx_cash_val, car_val, other_val)
+        if fig_tree is not None:
+            st.plotly_chart(fig_tree, use_container_width=True, key='treemap_chart')
         else:
             st.warning("暫無資產數據可顯示")
 
@@ -221,88 +281,22 @@ if not df_total.empty and len(df_total) > 0:
 
     with col_pnl:
         st.subheader("📊 未實現損益 (P&L)")
-        pnl_data = {
-            '美股': stock_val - stock_cost,
-            'ETF': etf_val - etf_cost,
-            '加密貨幣': crypto_val * 0.0, #TBD 
-        }
-        df_pnl = pd.DataFrame(list(pnl_data.items()), columns=['Asset', 'PnL'])
-        df_pnl['Color'] = np.where(df_pnl['PnL'] >= 0, '#00CC96', '#FF4B4B')
-        
-        fig_pnl = px.bar(df_pnl, x='PnL', y='Asset', orientation='h', text='PnL',
-                         title="各類資產損益貢獻 (估)", template="plotly_dark")
-        fig_pnl.update_traces(marker_color=df_pnl['Color'], texttemplate='%{text:,.0f}', textposition='auto')
-        st.plotly_chart(fig_pnl, use_container_width=True)
+        fig_pnl = build_pnl_fig(stock_val - stock_cost, etf_val - etf_cost, crypto_val * 0.0) #TBD 
+        st.plotly_chart(fig_pnl, use_container_width=True, key='pnl_chart')
 
     with col_curr:
         st.subheader("🌍 貨幣曝險")
         usd_exp = stock_val + crypto_val
         eur_exp = etf_val + fx_cash_val
         twd_exp = twd_cash_val + real_estate_val + other_val + car_val
-        
-        fig_pie = px.pie(
-            values=[usd_exp, eur_exp, twd_exp], 
-            names=['USD (美元)', 'EUR (歐元)', 'TWD (台幣)'],
-            color_discrete_sequence=['#00CC96', '#636EFA', '#EF553B'],
-            hole=0.5
-        )
-        fig_pie.update_layout(showlegend=True, height=350)
-        st.plotly_chart(fig_pie, use_container_width=True)
+        fig_pie = build_currency_fig(usd_exp, eur_exp, twd_exp)
+        st.plotly_chart(fig_pie, use_container_width=True, key='currency_chart')
 
     # --- Row 4: 預測模型 ---
-    st.divider()
-    st.subheader(f"🔮 未來 {forecast_years} 年資產模擬 (分項複利)")
-    
-    st.info(f"""
-    **模型參數：**
-    - 美股成長: **{rate_stock}%** | ETF成長: **{rate_etf}%** | 加密成長: **{rate_crypto}%**
-    - 房產/現金成長: **{rate_safe}%** | 汽車折舊: **{car_depreciation_rate}%**
-    - 每月投入: **${monthly_contribution:,.0f}**
-    """)
-
-    curr_date = latest['日期']
-    months = forecast_years * 12
-    
-    curr_stock = stock_val
-    curr_etf = etf_val
-    curr_crypto = crypto_val
     curr_safe = twd_cash_val + fx_cash_val + real_estate_val + other_val
-    curr_car = car_val * eur_rate
-    
-    invest_sum = stock_val + etf_val + crypto_val + curr_safe
-    if invest_sum == 0: invest_sum = 1
-    
-    alloc_stock = monthly_contribution * (stock_val / invest_sum)
-    alloc_etf = monthly_contribution * (etf_val / invest_sum)
-    alloc_crypto = monthly_contribution * (crypto_val / invest_sum)
-    alloc_safe = monthly_contribution * (curr_safe / invest_sum)
-
-    future_vals = []
-    for i in range(1, months + 1):
-        d = curr_date + relativedelta(months=i)
-        curr_stock = (curr_stock * (1 + rate_stock/100/12)) + alloc_stock
-        curr_etf = (curr_etf * (1 + rate_etf/100/12)) + alloc_etf
-        curr_crypto = (curr_crypto * (1 + rate_crypto/100/12)) + alloc_crypto
-        curr_safe = (curr_safe * (1 + rate_safe/100/12)) + alloc_safe
-        curr_car = curr_car * (1 - car_depreciation_rate/100/12)
-        if curr_car < 0: curr_car = 0
-        total = curr_stock + curr_etf + curr_crypto + curr_safe + curr_car
-        future_vals.append({'日期': d, 'Effective_Asset': total})
-        
-    df_fut = pd.DataFrame(future_vals)
-    df_hist = df_total[['日期', 'Effective_Asset']].copy()
-    df_hist['Type'] = 'History'
-    df_fut['Type'] = 'Forecast'
-    df_final = pd.concat([df_hist, df_fut])
-    
-    fig_cast = px.line(df_final, x='日期', y='Effective_Asset', color='Type', 
-                       template="plotly_dark", color_discrete_map={'History': '#00CC96', 'Forecast': '#FFA500'})
-    
-    fig_cast.add_hline(y=fire_goal, line_dash="dot", line_color="red", annotation_text=f"FIRE Goal")
-    st.plotly_chart(fig_cast, use_container_width=True)
-    
-    final_v = df_fut.iloc[-1]['Effective_Asset']
-    st.success(f"🎯 **預測結果：** {forecast_years} 年後資產約 **${final_v:,.0f}**")
+    forecast_panel(df_total, latest.date, (stock_val, etf_val, crypto_val, curr_safe),
+                   (rate_stock, rate_etf, rate_crypto, rate_safe), car_val * eur_rate,
+                   df_total.attrs['historical_avg_gain'], fire_goal)
 
 else:
     st.warning("⚠️ 讀取失敗")
\ No newline at end of file
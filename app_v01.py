@@ -1,11 +1,8 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import numpy as np
 from datetime import datetime
-from dateutil.relativedelta import relativedelta
-import re 
+from core import get_data, refresh_data, take_snapshots, compound, month_range, downsample_trend
 
 # --- 設定頁面資訊 ---
 st.set_page_config(page_title="Jeffy's FIRE 戰情室 🔥", page_icon="📈", layout="wide")
@@ -17,90 +14,142 @@ except KeyError:
     st.error("⚠️ **Secrets 錯誤:** 請確認您的 `secrets.toml` 中有設定 `[data]` 和 `sheet_url`。")
     st.stop() 
 
-# --- 讀取數據函數 ---
-@st.cache_data(ttl=10) 
-def load_data(url):
-    try:
-        df_total = pd.read_csv(url, header=1) 
-        df_total.columns = df_total.columns.str.strip() 
-        
-        target_cols = [
-            '真實總資產(TWD)', '總資產(TWD)',
-            '股票價值(USD)', '股票成本(USD)',
-            'ETF價值(EUR)', 'ETF(EUR)',
-            '台幣現金(TWD)', '外幣現金(EUR)', '不動產(TWD)', 
-            '加密貨幣(USD)', '其他(TWD)', 
-            'USDTWD', 'EURTWD', '總資產增額(TWD)'
-        ]
-        
-        # 1. 強力清洗：轉純數字
-        for col in target_cols:
-            if col in df_total.columns:
-                df_total[col] = df_total[col].astype(str).apply(
-                    lambda x: re.sub(r'[^\d\.\-]', '', x)
-                )
-                df_total[col] = pd.to_numeric(df_total[col], errors='coerce').fillna(0)
-            else:
-                df_total[col] = 0
+# --- 圖表建構 ---
+# Figure 以實際輸入為鍵放進 cache_resource：只動側邊欄預測參數時，其他圖直接取回同一個物件
+@st.cache_resource(max_entries=16)
+def build_trend_fig(df):
+    df_trend = downsample_trend(df)
+    fig = go.Figure(go.Scattergl(
+        x=df_trend['日期'], y=df_trend['Effective_Asset'], mode='lines+markers',
+        line=dict(color='#00CC96', width=3)
+    ))
+    fig.update_layout(title='Net Worth Growth (Real Value)', template="plotly_dark",
+                      xaxis_title='日期', yaxis_title='Effective_Asset')
+    return fig
 
-        # 2. 轉換日期
-        df_total['日期'] = pd.to_datetime(df_total['日期'], errors='coerce')
-        
-        # 3. [關鍵修正] 建立「有效數據」判斷
-        # 邏輯：優先使用 '真實總資產'，如果該月資料為 0 (歷史未填)，則回退使用 '總資產'
-        df_total['Effective_Asset'] = np.where(df_total['真實總資產(TWD)'] > 0, df_total['真實總資產(TWD)'], df_total['總資產(TWD)'])
-        
-        # 過濾：只保留 Effective_Asset > 0 的行 (這樣就會把 2026/1 這種空行濾掉，鎖定 2025/12)
-        df_total = df_total[df_total['Effective_Asset'] > 0].copy()
-        
-        df_total = df_total.sort_values('日期').reset_index(drop=True)
-        
-        return df_total
-    except Exception as e:
-        st.error(f"⚠️ 數據讀取錯誤: {e}") 
-        return pd.DataFrame() 
+@st.cache_resource(max_entries=16)
+def build_weight_pie_fig(labels, values):
+    return px.pie(values=values, names=labels, hole=0.4, 
+                  color_discrete_sequence=px.colors.sequential.RdBu)
+
+# 權重明細表同樣以輸入為鍵快取 (st.cache_data 每次回傳副本)；欄位保持數值，顯示格式交給 Styler
+@st.cache_data(max_entries=16)
+def build_weight_table(labels, values):
+    return pd.DataFrame({'資產種類': labels, '金額(TWD)': values, '占比(%)': values / values.sum() * 100})
+
+WEIGHT_TABLE_FORMAT = {'金額(TWD)': '${:,.0f}', '占比(%)': '{:.2f}%'}
+
+@st.cache_resource(max_entries=16)
+def build_forecast_fig(df_hist, df_fut, title):
+    # 歷史與預測直接畫成兩條 WebGL (scattergl) trace，省去 concat 與 px 依 Type 拆分
+    df_hist = downsample_trend(df_hist)
+    fig = go.Figure()
+    fig.add_trace(go.Scattergl(x=df_hist['日期'], y=df_hist['Effective_Asset'], mode='lines',
+                               name='歷史紀錄', line=dict(color='#00CC96')))
+    fig.add_trace(go.Scattergl(x=df_fut['日期'], y=df_fut['Effective_Asset'], mode='lines',
+                               name='未來預測', line=dict(color='#FFA500', dash='dot')))
+    fig.update_layout(title=title, template="plotly_dark", xaxis_title='日期', yaxis_title='Effective_Asset',
+                      legend_title_text='Type')
+    return fig
+
+# 資產權重圓餅圖的類別順序，與下方 weight_values 向量一一對應
+WEIGHT_LABELS = np.array(['不動產', '美股 (市值)', '台幣現金', '歐股/ETF (市值)', '外幣現金', '加密貨幣', '其他'])
+
+# --- 預測面板 ---
+# 只影響預測的參數 (年數、每月投入) 放在 fragment 裡：調整時只重跑這一區，KPI 與上方圖表不必重畫
+# (fragment 不能寫入側邊欄，所以這兩個控制項改放在預測區塊內)
+@st.fragment
+def forecast_panel(df_hist, current_date, values, weights, rates, weighted_cagr, scenario, default_contribution):
+    val_stock, val_etf, val_crypto, curr_safe = values
+    w_stock, w_etf, w_crypto, w_safe = weights
+    rate_stock, rate_etf, rate_crypto, rate_safe = rates
+
+    st.divider()
+    title = st.empty()
+    col_y, col_m = st.columns(2)
+    forecast_years = col_y.slider("模擬未來年數", 1, 27, 5)
+    monthly_contribution = col_m.number_input("每月投入資金 (TWD)", value=int(default_contribution), step=5000)
+    title.subheader(f"🔮 {forecast_years} 年資產模擬 (加權成分成長模型)")
+    st.info(f"""
+    **模型邏輯 (基於真實價值)：**
+    - **{w_stock*100:.1f}%** 個股 (CAGR {rate_stock}%) | **{w_etf*100:.1f}%** ETF (CAGR {rate_etf}%)
+    - **{w_crypto*100:.1f}%** 加密 (CAGR {rate_crypto}%) | **{w_safe*100:.1f}%** 防禦 (CAGR {rate_safe}%)
+    👉 **綜合年化成長率 (Weighted CAGR): {weighted_cagr:.2f}%**
+    """)
+
+    forecast_months = forecast_years * 12
+    
+    monthly_in_stock = monthly_contribution * w_stock
+    monthly_in_etf = monthly_contribution * w_etf
+    monthly_in_crypto = monthly_contribution * w_crypto
+    monthly_in_safe = monthly_contribution * w_safe
+
+    car_value = 71000
+    rate_car = 24
+
+    # 各類資產以封閉解一次算出整段月序列 (取代逐月迴圈)
+    n = np.arange(1, forecast_months + 1)
+    total_forecast = (
+        compound(val_stock, rate_stock, monthly_in_stock, n)
+        + compound(val_etf, rate_etf, monthly_in_etf, n)
+        + compound(val_crypto, rate_crypto, monthly_in_crypto, n)
+        + compound(curr_safe, rate_safe, monthly_in_safe, n)
+        + car_value * ( 1 - rate_car/100/12)**24 * 36
+    )
+
+    df_forecast = pd.DataFrame({'日期': month_range(current_date, forecast_months), 'Effective_Asset': total_forecast})
+    
+    fig_forecast = build_forecast_fig(df_hist, df_forecast,
+                                      f'情境模擬: {scenario} (綜合 CAGR {weighted_cagr:.2f}%)')
+    # 固定 key：圖表身分不隨 figure 內容改變，拉動滑桿時前端原地更新 trace 而不是整張重建
+    st.plotly_chart(fig_forecast, use_container_width=True, key='forecast_chart')
+    
+    final_val = total_forecast[-1]
+    st.success(f"🎯 **模擬結果：** {forecast_years} 年後總資產預估 **${final_val:,.0f} TWD**。")
 
-df_total = load_data(SPREADSHEET_URL)
+# --- 讀取數據 (下載、清洗、快取都在 core.py) ---
+df_total = get_data(SPREADSHEET_URL, '總資產(TWD)', 'fire_dashboard_v01')
 
 # --- 介面呈現 ---
 st.title("🔥 Jeffy 的 FIRE 戰情室 - Pro Valuation Edition")
 
 if not df_total.empty and len(df_total) > 0:
+    # plotly 只在有資料要畫圖時才載入 (首次載入約數百 ms)，讀取失敗的畫面不必等它
+    import plotly.express as px
+    import plotly.graph_objects as go
     
     # --- 基礎數據 (現在抓到的一定是有效數據的最後一筆) ---
-    latest = df_total.iloc[-1]
-    prev = df_total.iloc[-2] if len(df_total) > 1 else latest
+    latest, prev = take_snapshots(df_total, -1, -2 if len(df_total) > 1 else -1)
     
     # 匯率
-    raw_usd_rate = latest.get('USDTWD', 0)
-    raw_eur_rate = latest.get('EURTWD', 0)
+    raw_usd_rate = latest.usd_twd
+    raw_eur_rate = latest.eur_twd
     usd_rate = raw_usd_rate if raw_usd_rate > 10 else 32.5
     eur_rate = raw_eur_rate if raw_eur_rate > 10 else 35.0
     
     # --- 資產價值計算 (使用真實價值) ---
-    val_stock = latest.get('股票價值(USD)', 0) * usd_rate
-    val_etf = latest.get('ETF價值(EUR)', 0) * eur_rate
+    val_stock = latest.stock_usd * usd_rate
+    val_etf = latest.etf_eur * eur_rate
     
     # 如果真實價值是 0，自動 fallback 到成本 (僅供圓餅圖顯示用)
-    if val_stock == 0: val_stock = latest.get('股票成本(USD)', 0) * usd_rate
-    if val_etf == 0: val_etf = latest.get('ETF(EUR)', 0) * eur_rate
+    if val_stock == 0: val_stock = latest.stock_cost_usd * usd_rate
+    if val_etf == 0: val_etf = latest.etf_cost_eur * eur_rate
 
-    val_crypto = latest.get('加密貨幣(USD)', 0) * usd_rate
-    val_foreign_cash = latest.get('外幣現金(EUR)', 0) * eur_rate
-    val_twd_cash = latest.get('台幣現金(TWD)', 0)
-    val_real_estate = latest.get('不動產(TWD)', 0)
-    val_other = latest.get('其他(TWD)', 0)
+    val_crypto = latest.crypto_usd * usd_rate
+    val_foreign_cash = latest.fx_cash_eur * eur_rate
+    val_twd_cash = latest.twd_cash
+    val_real_estate = latest.real_estate
+    val_other = latest.other
     
     # --- [關鍵] 總資產 KPI - 不再有 fallback ---
-    current_assets = latest['Effective_Asset']
-    prev_assets = prev['Effective_Asset']
+    current_assets = latest.effective_asset
+    prev_assets = prev.effective_asset
     
     month_diff = current_assets - prev_assets
     growth_rate = (month_diff / prev_assets) * 100 if prev_assets != 0 else 0
     
     # 歷史平均月儲蓄
-    df_gains = df_total[df_total['總資產增額(TWD)'] > 0]
-    historical_avg_gain = df_gains['總資產增額(TWD)'].mean() if not df_gains.empty else 50000
+    historical_avg_gain = df_total.attrs['historical_avg_gain']
 
     # --- 側邊欄 ---
     with st.sidebar:
@@ -109,7 +158,6 @@ if not df_total.empty and len(df_total) > 0:
         st.divider()
         
         st.subheader("🔮 分析師估值模型")
-        forecast_years = st.slider("模擬未來年數", 1, 27, 5)
 
         scenario = st.selectbox(
             "選擇分析師/市場情境",
@@ -135,11 +183,9 @@ if not df_total.empty and len(df_total) > 0:
         col_s3, col_s4 = st.columns(2)
         rate_crypto = col_s3.number_input("加密貨幣", value=rate_stock if "自訂" in scenario else 20.0, step=1.0, format="%.1f")
         rate_safe = col_s4.number_input("房產/現金", value=def_safe_rate, step=0.1, format="%.1f")
-
-        monthly_contribution = st.number_input("每月投入資金 (TWD)", value=int(historical_avg_gain), step=5000)
         
         if st.button("🔄 刷新數據"):
-            st.cache_data.clear()
+            refresh_data()
             st.rerun()
 
     # --- 邏輯運算 ---
@@ -178,102 +224,41 @@ if not df_total.empty and len(df_total) > 0:
 
     with col_chart1:
         st.subheader("📈 資產累積趨勢 (真實價值)")
-        fig_trend = px.line(df_total, x='日期', y='Effective_Asset', markers=True, title='Net Worth Growth (Real Value)', template="plotly_dark")
-        fig_trend.update_traces(line_color='#00CC96', line_width=3)
-        st.plotly_chart(fig_trend, use_container_width=True)
+        fig_trend = build_trend_fig(df_total)
+        st.plotly_chart(fig_trend, use_container_width=True, key='trend_chart')
 
     with col_chart2:
         st.subheader("🍰 資產權重分布")
-        assets_dict_detail = {
-            '不動產': val_real_estate,
-            '美股 (市值)': val_stock, 
-            '台幣現金': val_twd_cash,
-            '歐股/ETF (市值)': val_etf, 
-            '外幣現金': val_foreign_cash,
-            '加密貨幣': val_crypto,
-            '其他': val_other
-        }
+        weight_values = np.array([
+            val_real_estate, val_stock, val_twd_cash, val_etf,
+            val_foreign_cash, val_crypto, val_other
+        ], dtype=np.float64)
+        mask = weight_values > 0
         
-        df_display = pd.DataFrame([
-            {'資產種類': k, '金額(TWD)': v, 'Raw_Value': v} 
-            for k, v in assets_dict_detail.items() if v > 0
-        ])
-        
-        if not df_display.empty:
-            total_display_val = df_display['Raw_Value'].sum()
-            df_display['占比(%)'] = (df_display['Raw_Value'] / total_display_val * 100)
-            df_display = df_display.sort_values(by='Raw_Value', ascending=False)
+        if mask.any():
+            # 只留 > 0 的項目，金額由大到小排序
+            order = np.argsort(-weight_values[mask], kind='stable')
+            weight_labels = WEIGHT_LABELS[mask][order]
+            weight_values = weight_values[mask][order]
             
-            fig_pie = px.pie(df_display, values='Raw_Value', names='資產種類', hole=0.4, 
-                             color_discrete_sequence=px.colors.sequential.RdBu)
-            st.plotly_chart(fig_pie, use_container_width=True)
+            fig_pie = build_weight_pie_fig(weight_labels, weight_values)
+            st.plotly_chart(fig_pie, use_container_width=True, key='weight_pie_chart')
             
-            df_table = df_display[['資產種類', '金額(TWD)', '占比(%)']].copy()
-            df_table['金額(TWD)'] = df_table['金額(TWD)'].map('${:,.0f}'.format)
-            df_table['占比(%)'] = df_table['占比(%)'].map('{:.2f}%'.format)
-            st.dataframe(df_table, use_container_width=True, hide_index=True)
+            df_table = build_weight_table(weight_labels, weight_values)
+            st.dataframe(df_table.style.format(WEIGHT_TABLE_FORMAT), use_container_width=True, hide_index=True)
         else:
             st.warning("無有效資產數據")
 
     # --- 預測模型區 ---
-    st.divider()
-    st.subheader(f"🔮 {forecast_years} 年資產模擬 (加權成分成長模型)")
-    st.info(f"""
-    **模型邏輯 (基於真實價值)：**
-    - **{w_stock*100:.1f}%** 個股 (CAGR {rate_stock}%) | **{w_etf*100:.1f}%** ETF (CAGR {rate_etf}%)
-    - **{w_crypto*100:.1f}%** 加密 (CAGR {rate_crypto}%) | **{w_safe*100:.1f}%** 防禦 (CAGR {rate_safe}%)
-    👉 **綜合年化成長率 (Weighted CAGR): {weighted_cagr:.2f}%**
-    """)
-
-    current_date = latest['日期']
-    forecast_months = forecast_years * 12
-    future_data = []
-    
-    curr_stock = val_stock
-    curr_etf = val_etf
-    curr_crypto = val_crypto
     curr_safe = val_twd_cash + val_foreign_cash + val_real_estate + val_other
-    
-    monthly_in_stock = monthly_contribution * w_stock
-    monthly_in_etf = monthly_contribution * w_etf
-    monthly_in_crypto = monthly_contribution * w_crypto
-    monthly_in_safe = monthly_contribution * w_safe
-
-    car_value = 71000
-    rate_car = 24
-
-    for i in range(1, forecast_months + 1):
-        future_date = current_date + relativedelta(months=i)
-        
-        curr_stock = (curr_stock * (1 + rate_stock/100/12)) + monthly_in_stock
-        curr_etf = (curr_etf * (1 + rate_etf/100/12)) + monthly_in_etf
-        curr_crypto = (curr_crypto * (1 + rate_crypto/100/12)) + monthly_in_crypto
-        curr_safe = (curr_safe * (1 + rate_safe/100/12)) + monthly_in_safe
-        
-        total_forecast = curr_stock + curr_etf + curr_crypto + curr_safe + car_value * ( 1 - rate_car/100/12)**24 * 36
-        future_data.append({'日期': future_date, 'Effective_Asset': total_forecast})
-
-    df_forecast = pd.DataFrame(future_data)
-    
-    df_history = df_total[['日期', 'Effective_Asset']].copy()
-    df_history['Type'] = '歷史紀錄'
-    df_forecast['Type'] = '未來預測'
-    df_combined = pd.concat([df_history, df_forecast])
-    
-    fig_forecast = px.line(df_combined, x='日期', y='Effective_Asset', color='Type',
-                           title=f'情境模擬: {scenario} (綜合 CAGR {weighted_cagr:.2f}%)', 
-                           template="plotly_dark",
-                           color_discrete_map={'歷史紀錄': '#00CC96', '未來預測': '#FFA500'})
-    fig_forecast.update_traces(selector=dict(name='未來預測'), line=dict(dash='dot'))
-    st.plotly_chart(fig_forecast, use_container_width=True)
-    
-    final_val = df_forecast.iloc[-1]['Effective_Asset']
-    st.success(f"🎯 **模擬結果：** {forecast_years} 年後總資產預估 **${final_val:,.0f} TWD**。")
+    forecast_panel(df_total, latest.date, (val_stock, val_etf, val_crypto, curr_safe),
+                   (w_stock, w_etf, w_crypto, w_safe), (rate_stock, rate_etf, rate_crypto, rate_safe),
+                   weighted_cagr, scenario, historical_avg_gain)
 
     # Debug
     #with st.expander("🔍 **數據除錯 (Debug)**"):
     #    st.subheader("最新一筆有效數據 (已過濾未來空行)")
-    #    st.write(f"最新日期: **{latest['日期'].strftime('%Y/%m')}**")
+    #    st.write(f"最新日期: **{latest.date.strftime('%Y/%m')}**")
     #    st.dataframe(df_total.tail(5))
 
 else:
@@ -0,0 +1,375 @@
+# FIRE 戰情室共用的資料層：下載、清洗、快取試算表，以及預測與降採樣工具 (app.py、app_v01.py 共用)
+import streamlit as st
+import pandas as pd
+import numpy as np
+import re
+import math
+import csv
+import io
+import json
+import os
+import hashlib
+import tempfile
+import time
+import requests
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+from typing import NamedTuple
+
+# --- 讀取數據函數 ---
+# 數值清洗用正則：只保留數字、小數點與負號 (預先編譯，避免每格重新解析)
+_NUM_RE = re.compile(r'[^\d\.\-]')
+
+def _to_number(x):
+    # 單格清洗 + 轉數字一次完成；空白、無法解析、NaN 或 inf 一律視為 0 (與正則清洗的結果一致)
+    # 絕大多數格子只多了千分位逗號，先用 str.replace 直接轉；含貨幣符號等其他字元才交給正則
+    if isinstance(x, str):
+        try:
+            x = float(x.replace(',', ''))
+        except ValueError:
+            x = _NUM_RE.sub('', x)
+    try:
+        x = float(x)
+    except (TypeError, ValueError):
+        return 0.0
+    return x if math.isfinite(x) else 0.0
+
+def _clean_column(arr):
+    # 整欄清洗：pyarrow 以 C 實作的正則一次去掉非數字字元再轉 float64，空白格補 0
+    # 有格子清完仍無法解析 (例如只剩 '-') 才整欄退回逐格清洗
+    try:
+        # 已經是乾淨數字的欄位 (例如匯率) 直接轉型，不必跑正則
+        values = pc.fill_null(arr.cast(pa.float64()), 0.0).to_numpy()
+    except pa.ArrowInvalid:
+        pass
+    else:
+        # 轉型會接受 'inf'、'-Infinity'、'nan' 這類字樣，正則清洗則會把它們清成 0；這裡同樣補 0
+        finite = np.isfinite(values)
+        return values if finite.all() else np.where(finite, values, 0.0)
+    stripped = pc.replace_substring_regex(arr, pattern=_NUM_RE.pattern, replacement='')
+    stripped = pc.if_else(pc.equal(stripped, ''), None, stripped)
+    try:
+        return pc.fill_null(stripped.cast(pa.float64()), 0.0).to_numpy()
+    except pa.ArrowInvalid:
+        return np.fromiter(map(_to_number, arr.to_pylist()), dtype=np.float64, count=len(arr))
+
+# 試算表日期格式：讀檔時就由 pyarrow 以固定格式解析 (C 實作)，不符合的格子才交給 pandas 逐格推斷
+DATE_FORMAT = '%Y/%m/%d'
+
+def _parse_dates(arr):
+    dates = pc.strptime(arr, format=DATE_FORMAT, unit='ns', error_is_null=True).to_pandas()
+    bad = dates.isna().to_numpy() & pc.is_valid(arr).to_numpy(zero_copy_only=False)
+    if bad.any():
+        s = arr.to_pandas()
+        dates[bad] = pd.to_datetime(s[bad], format='mixed', errors='coerce')
+    return dates
+
+# --- 本地 Parquet 快取 ---
+# 以 CSV 原始內容的雜湊判斷試算表是否變動：沒變就直接讀已清洗好的 Parquet，跳過解析與清洗
+# 每個儀表板用自己的快取檔 (cache_name)，有效資產的回退欄位不同，清洗結果也不同
+# 清洗結果的格式改變時遞增 CACHE_VERSION，舊版快取檔就不會再被讀到
+CACHE_DIR = tempfile.gettempdir()
+CACHE_VERSION = 4
+
+def _read_cache(path, digest):
+    try:
+        with open(path + '.sha1') as f:
+            if f.read() == digest:
+                return pd.read_parquet(path)
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _write_cache(path, df, digest):
+    # 快取只是加速用，寫入失敗 (唯讀磁碟、欄位型別不相容) 不影響主流程
+    try:
+        df.to_parquet(path, compression='zstd')
+        with open(path + '.sha1', 'w') as f:
+            f.write(digest)
+    except Exception:
+        pass
+
+@st.cache_resource
+def _http_session():
+    # 共用連線池 (keep-alive)，快取過期重抓試算表時不必重新建立 HTTPS 連線
+    return requests.Session()
+
+def _read_validators(path, url):
+    # 上次下載時伺服器給的 ETag / Last-Modified，以及當時 CSV 內容的雜湊
+    # 只認同一個網址留下的紀錄：試算表網址換了，舊表的 ETag 送給新網址可能換來 304，進而讀到舊表的快取
+    try:
+        with open(path + '.http') as f:
+            seen = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return seen if seen.get('url') == url else {}
+
+def _fetch_csv(url, path, conditional=True):
+    # 條件式請求：帶上次的 ETag / Last-Modified，試算表沒變時伺服器回 304，連下載都省掉
+    # 回傳 (CSV 內容, 雜湊)；304 時內容為 None，雜湊沿用上次的
+    seen = _read_validators(path, url) if conditional else {}
+    headers = {}
+    if seen.get('etag'):
+        headers['If-None-Match'] = seen['etag']
+    if seen.get('last_modified'):
+        headers['If-Modified-Since'] = seen['last_modified']
+    resp = _http_session().get(url, headers=headers, timeout=30)
+    if resp.status_code == 304 and seen.get('sha1'):
+        return None, seen['sha1']
+    resp.raise_for_status()
+    raw_csv = resp.content
+    digest = hashlib.sha1(raw_csv).hexdigest()
+    try:
+        with open(path + '.http', 'w') as f:
+            json.dump({
+                'url': url,
+                'etag': resp.headers.get('ETag'),
+                'last_modified': resp.headers.get('Last-Modified'),
+                'sha1': digest,
+            }, f)
+    except OSError:
+        pass
+    return raw_csv, digest
+
+# 要清洗成數值的試算表欄位
+TARGET_COLS = (
+    '真實總資產(TWD)', '總資產(TWD)', '總資產+汽車折舊', '汽車預估價格(GPT模型)',
+    '股票價值(USD)', '股票成本(USD)', 
+    'ETF價值(EUR)', 'ETF(EUR)', 
+    '台幣現金(TWD)', '外幣現金(EUR)', '不動產(TWD)', 
+    '加密貨幣(USD)', '其他(TWD)', 
+    'USDTWD', 'EURTWD', '總資產增額(TWD)'
+)
+# CSV 每次解析的區塊大小；表再大也只會有一個區塊的字串同時在記憶體裡
+CSV_BLOCK_SIZE = 1 << 20
+
+def _read_header(raw_csv):
+    # 第一列是說明列，第二列才是標題：這兩筆記錄交給 csv.reader (引號內的換行不算列尾)，
+    # 回傳去掉前後空白的標題，以及資料列起點的位元組位置；csv.reader 逐行讀取不會多讀，已讀行數的長度就是起點
+    consumed = 0
+    def lines():
+        nonlocal consumed
+        for line in io.BytesIO(raw_csv):
+            consumed += len(line)
+            yield line.decode('utf-8')
+    reader = csv.reader(lines())
+    next(reader)
+    header = next(reader)
+    return [c.strip() for c in header], consumed
+
+# 試算表通常一個月才更新幾次，資料快取 10 分鐘；要立刻看到新資料就按側邊欄的「刷新」按鈕
+DATA_TTL = 600
+
+# 讀取失敗時直接拋出例外：st.cache_data 不快取例外，網路恢復後下一次 rerun 就會重新下載，
+# 不會把空表快取整整一個 TTL；錯誤訊息由 get_data 在快取函數外顯示
+@st.cache_data(ttl=DATA_TTL, show_spinner=False)
+def load_data(url, fallback_col, cache_name):
+    # fallback_col：真實總資產未填 (0) 的月份改用哪一欄當有效資產
+    cache_path = os.path.join(CACHE_DIR, f'{cache_name}.v{CACHE_VERSION}.parquet')
+    raw_csv, digest = _fetch_csv(url, cache_path)
+    cached = _read_cache(cache_path, digest)
+    if cached is not None:
+        cached.attrs['loaded_at'] = time.time()
+        return cached
+    if raw_csv is None:
+        # 伺服器回 304 但本地快取已不在：不帶條件重新下載
+        raw_csv, digest = _fetch_csv(url, cache_path, conditional=False)
+
+    # 標題先自行解析 (去掉前後空白)，之後只挑需要的欄位
+    header, data_offset = _read_header(raw_csv)
+    present_cols = [c for c in TARGET_COLS if c in header]
+    read_cols = ['日期'] + present_cols
+
+    # pyarrow 串流解析：從資料列起點開始 (零複製切片)，一次只讀一個區塊、只轉需要的欄位 (備註、右側空白欄不進記憶體)
+    reader = pa_csv.open_csv(
+        pa.BufferReader(pa.py_buffer(raw_csv).slice(data_offset)),
+        read_options=pa_csv.ReadOptions(column_names=header, block_size=CSV_BLOCK_SIZE),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=read_cols,
+            column_types=dict.fromkeys(read_cols, pa.string()),
+            strings_can_be_null=True,
+        ),
+    )
+
+    # 真實總資產與回退欄都空白的列 (試算表尾端預留的範本列) 有效資產必為 0，最後一定會被濾掉
+    asset_cols = [c for c in ('真實總資產(TWD)', fallback_col) if c in present_cols]
+
+    # 強力清洗：逐塊、逐欄向量化清洗成 float64，只留下數值區塊，大表也不會一次展開成整張 object 表
+    date_parts, blocks = [], []
+    for batch in reader:
+        # 先丟掉上述空白列再清洗，範本列很多時可省下大部分清洗工作
+        filled = pa.array(np.zeros(batch.num_rows, dtype=bool))
+        for col in asset_cols:
+            filled = pc.or_(filled, pc.is_valid(batch.column(col)))
+        batch = batch.filter(filled)
+        date_parts.append(_parse_dates(batch.column('日期')))
+        block = np.empty((batch.num_rows, len(present_cols)))
+        for j, col in enumerate(present_cols):
+            block[:, j] = _clean_column(batch.column(col))
+        blocks.append(block)
+
+    if blocks:
+        numeric = np.concatenate(blocks)
+        dates = pd.concat(date_parts, ignore_index=True)
+    else:
+        numeric = np.empty((0, len(present_cols)))
+        dates = pd.Series([], dtype='datetime64[ns]')
+    data = {'日期': dates.to_numpy()}
+
+    # 金額一律保留 float64：總資產動輒數千萬 TWD，float32 超過 16,777,216 就無法精確表示整數元；缺少的欄位補 0
+    col_index = {c: j for j, c in enumerate(present_cols)}
+    for col in TARGET_COLS:
+        if col in col_index:
+            data[col] = numeric[:, col_index[col]]
+        else:
+            data[col] = np.zeros(len(numeric))
+    
+    # 建立有效資產：優先使用 '真實總資產'，該月資料為 0 (歷史未填) 時回退到 fallback_col
+    real = data['真實總資產(TWD)']
+    data['Effective_Asset'] = np.where(real > 0, real, data[fallback_col])
+    
+    # 過濾無效行並依日期排序 (NaT 排最後)：全在 NumPy 陣列上算好列順序，
+    # 整張表只在最後依型別合併成連續區塊建一次，不必先建表再 take
+    keep = np.flatnonzero(data['Effective_Asset'] > 0)
+    rows = keep[np.argsort(data['日期'][keep], kind='stable')]
+    df_total = pd.DataFrame({col: values[rows] for col, values in data.items()})
+
+    # 歷史平均月儲蓄只跟資料有關，跟著快取一起算好 (attrs 會一併存進 Parquet)
+    gains = df_total['總資產增額(TWD)'].to_numpy()
+    gains = gains[gains > 0]
+    df_total.attrs['historical_avg_gain'] = float(gains.mean()) if gains.size else 50000.0
+    
+    _write_cache(cache_path, df_total, digest)
+    # 這份快取建立的時間，get_data 依此判斷 session 裡記住的資料是否過期
+    df_total.attrs['loaded_at'] = time.time()
+    return df_total
+
+# --- 預測模型工具 ---
+def compound(principal, annual_rate, contribution, n):
+    # 月複利 + 每月定額投入的封閉解：v_n = p*(1+r)^n + c*((1+r)^n - 1)/r，n 為月數陣列
+    r = annual_rate / 100 / 12
+    if r == 0:
+        return principal + contribution * n
+    growth = (1 + r) ** n
+    return principal * growth + contribution * (growth - 1) / r
+
+def month_range(start, months):
+    # 等同 [start + relativedelta(months=i) for i in 1..months]，日期超出當月天數時截到月底
+    month = np.datetime64(start, 'M') + np.arange(1, months + 1)
+    first_day = month.astype('datetime64[D]')
+    last_day = (month + 1).astype('datetime64[D]') - 1
+    return pd.DatetimeIndex(np.minimum(first_day + (start.day - 1), last_day))
+
+# --- 圖表工具 ---
+TREND_MAX_POINTS = 1000
+
+def _lttb(x, y, n_out):
+    # Largest-Triangle-Three-Buckets 降採樣：保留曲線形狀，回傳要保留的列索引
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nxt = slice(hi, edges[i + 2]) if i + 2 < len(edges) else slice(n - 1, n)
+        avg_x, avg_y = x[nxt].mean(), y[nxt].mean()
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(area.argmax())
+        idx[i + 1] = a
+    return idx
+
+def downsample_trend(df):
+    # 歷史資料點過多時先降採樣，避免整段資料都送進瀏覽器渲染
+    if len(df) <= TREND_MAX_POINTS:
+        return df
+    x = df['日期'].to_numpy('datetime64[ns]').astype(np.int64).astype(np.float64)
+    y = df['Effective_Asset'].to_numpy(np.float64)
+    return df.iloc[_lttb(x, y, TREND_MAX_POINTS)]
+
+# --- 最新數據快照 ---
+# 屬性名稱 → 試算表欄位；KPI 區只讀這幾個純量，不必為此建整列 pandas Series
+SNAPSHOT_FIELDS = {
+    'date': '日期',
+    'effective_asset': 'Effective_Asset',
+    'usd_twd': 'USDTWD',
+    'eur_twd': 'EURTWD',
+    'stock_usd': '股票價值(USD)',
+    'stock_cost_usd': '股票成本(USD)',
+    'etf_eur': 'ETF價值(EUR)',
+    'etf_cost_eur': 'ETF(EUR)',
+    'crypto_usd': '加密貨幣(USD)',
+    'fx_cash_eur': '外幣現金(EUR)',
+    'twd_cash': '台幣現金(TWD)',
+    'real_estate': '不動產(TWD)',
+    'other': '其他(TWD)',
+    'car': '汽車預估價格(GPT模型)',
+}
+
+class Snapshot(NamedTuple):
+    date: pd.Timestamp
+    effective_asset: float
+    usd_twd: float
+    eur_twd: float
+    stock_usd: float
+    stock_cost_usd: float
+    etf_eur: float
+    etf_cost_eur: float
+    crypto_usd: float
+    fx_cash_eur: float
+    twd_cash: float
+    real_estate: float
+    other: float
+    car: float
+
+def take_snapshots(df, *rows):
+    # 取指定列 (可為負索引) 的快照；每個欄位只取一次 NumPy 陣列，多列共用，表中沒有的欄位視為 0
+    columns = []
+    for name, col in SNAPSHOT_FIELDS.items():
+        columns.append((name, df[col].to_numpy() if col in df.columns else None))
+    snapshots = []
+    for i in rows:
+        values = []
+        for name, arr in columns:
+            if arr is None:
+                values.append(0.0)
+            elif name == 'date':
+                values.append(pd.Timestamp(arr[i]))
+            else:
+                values.append(float(arr[i]))
+        snapshots.append(Snapshot._make(values))
+    return snapshots
+
+# 所有 session 共用的刷新計數：任何 session 按「刷新」都會遞增，其他 session 記住的資料隨之失效
+@st.cache_resource
+def _data_generation():
+    return [0]
+
+def refresh_data():
+    st.cache_data.clear()
+    _data_generation()[0] += 1
+
+# 每個 session 依 (網址, 快取名稱) 記住上次載入的資料，未過期的 rerun 直接沿用，不必再查 st.cache_data
+# 過期時間從 st.cache_data 建立這份資料時起算 (attrs['loaded_at'])，與快取本身的 TTL 一致
+# 讀取失敗或沒有有效資料時不寫進 session，下一次 rerun 會再試一次
+def get_data(url, fallback_col, cache_name):
+    key = f'df_total:{cache_name}:{url}'
+    generation = _data_generation()[0]
+    memo = st.session_state.get(key)
+    if memo is not None:
+        df_total, memo_generation = memo
+        if memo_generation == generation and time.time() - df_total.attrs['loaded_at'] <= DATA_TTL:
+            return df_total
+    try:
+        df_total = load_data(url, fallback_col, cache_name)
+    except Exception as e:
+        st.error(f"⚠️ 數據讀取錯誤: {e}") 
+        return pd.DataFrame() 
+    if df_total.empty:
+        return df_total
+    st.session_state[key] = (df_total, generation)
+    return df_total
+